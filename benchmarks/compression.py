@@ -0,0 +1,100 @@
+"""
+Compares the available Cache compression settings on a typical workload (JSON-like API responses), reporting the
+resulting database and stored data sizes, the time to write all entries and the time to read them back (which
+includes the decompression cost).
+
+Usage:
+    python benchmarks/compression.py [--entries N] [--threshold BYTES] [--small]
+
+With --small, each entry is a single result (a few hundred bytes), which is where the trained dictionary (zdict) helps
+the most. The zdict run trains its dictionary from a first pass of writes, which is not included in the timings (but
+may leave free pages behind, so compare the data sizes).
+"""
+
+import argparse
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib"))
+
+from cached import Cache  # noqa: E402
+
+
+def make_item(i, j):
+    return {
+        "id": i * 100 + j,
+        "title": "Movie title number {}".format(i * 100 + j),
+        "overview": "A fairly long overview of movie {}, as returned by most metadata providers.".format(j),
+        "original_language": "en",
+        "adult": False,
+        "vote_average": 6.5 + j % 3,
+        "genre_ids": [28, 12, 16][:j % 3 + 1],
+        "popularity": 12.5 * j,
+        "poster_path": "/poster{}.jpg".format(j),
+    }
+
+
+def make_value(i):
+    return {
+        "page": i % 20 + 1,
+        "total_results": 10000 + i,
+        "results": [make_item(i, j) for j in range(20)],
+    }
+
+
+def run(directory, compression, values, threshold):
+    database = os.path.join(directory, "{}.sqlite".format(compression))
+    cache = Cache(database, compression=compression, compression_threshold=threshold)
+    ttl = timedelta(hours=1)
+    if compression == "zdict":
+        for i, value in enumerate(values):
+            cache.set(i, value, ttl, identifier="")
+        cache.train_zdict()
+
+    start = time.perf_counter()
+    for i, value in enumerate(values):
+        cache.set(i, value, ttl, identifier="")
+    write = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for i in range(len(values)):
+        cache.get(i, identifier="")
+    read = time.perf_counter() - start
+
+    cache.close()
+    size = sum(os.path.getsize(database + suffix) for suffix in ("", "-wal") if os.path.exists(database + suffix))
+    conn = sqlite3.connect(database)
+    data_size = conn.execute("SELECT SUM(size) FROM `cached`").fetchone()[0]
+    conn.close()
+    return size, data_size, write, read
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Cache compression")
+    parser.add_argument("--entries", type=int, default=500)
+    parser.add_argument("--threshold", type=int, default=1024)
+    parser.add_argument("--small", action="store_true")
+    args = parser.parse_args()
+
+    if args.small:
+        values = [make_item(i, i % 20) for i in range(args.entries)]
+    else:
+        values = [make_value(i) for i in range(args.entries)]
+    directory = tempfile.mkdtemp()
+    try:
+        print("{:<8} {:>10} {:>10} {:>10} {:>10}".format("codec", "file (KB)", "data (KB)", "write (ms)", "read (ms)"))
+        for compression in (None, "zlib", "bz2", "lzma", "zdict"):
+            size, data_size, write, read = run(directory, compression, values, args.threshold)
+            print("{:<8} {:>10.0f} {:>10.0f} {:>10.1f} {:>10.1f}".format(
+                str(compression), size / 1024.0, data_size / 1024.0, write * 1000, read * 1000))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
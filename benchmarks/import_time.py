@@ -0,0 +1,85 @@
+"""
+Measures the cold start cost of the cached module, that is, the time a fresh interpreter takes to import it and
+decorate a number of functions (which is what every Kodi plugin invocation pays before doing any actual work).
+
+Usage:
+    python benchmarks/import_time.py [--lib PATH] [--baseline REV] [--runs N] [--functions N]
+
+The lib directory is compared against the module of a git revision (by default, the first commit of the repository).
+Runs of both alternate, so they are equally affected by anything else running on the machine. Revisions which
+initialise the module eagerly need the Kodi modules (xbmc, xbmcaddon, ...) to be importable, for instance from stubs
+added to PYTHONPATH. Pass an empty --baseline to only measure the lib directory.
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+SNIPPET = """
+import time
+start = time.perf_counter()
+from datetime import timedelta
+import cached
+for i in range({functions}):
+    cached.cached(timedelta(minutes=15))(lambda *args: args)
+print(time.perf_counter() - start)
+"""
+
+
+def run(lib, functions):
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(p for p in (lib, env.get("PYTHONPATH")) if p)
+    # Measure with cached bytecode, as it would be in a regular installation
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    output = subprocess.check_output([sys.executable, "-c", SNIPPET.format(functions=functions)], env=env)
+    return float(output.decode().strip().splitlines()[-1])
+
+
+def checkout(rev, path):
+    if not rev:
+        rev = subprocess.check_output(["git", "rev-list", "--max-parents=0", "HEAD"], cwd=ROOT).decode().split()[0]
+    with open(os.path.join(path, "cached.py"), "wb") as f:
+        f.write(subprocess.check_output(["git", "show", rev + ":lib/cached.py"], cwd=ROOT))
+    return rev
+
+
+def report(name, timings):
+    print("{}: median {:.3f} ms, min {:.3f} ms, max {:.3f} ms".format(
+        name, statistics.median(timings) * 1000, min(timings) * 1000, max(timings) * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark cached module import time")
+    parser.add_argument("--lib", default=os.path.join(ROOT, "lib"))
+    parser.add_argument("--baseline", default=None, help="git revision to compare against (default: first commit)")
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--functions", type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as baseline_lib:
+        libs = {"lib": args.lib}
+        if args.baseline != "":
+            libs["baseline " + checkout(args.baseline, baseline_lib)[:12]] = baseline_lib
+        timings = {name: [] for name in libs}
+        # The first run of each writes its bytecode
+        for lib in libs.values():
+            run(lib, args.functions)
+        for _ in range(args.runs):
+            for name, lib in libs.items():
+                timings[name].append(run(lib, args.functions))
+
+    print("import + {} decorations ({} runs)".format(args.functions, args.runs))
+    for name in libs:
+        report(name, timings[name])
+    if len(libs) > 1:
+        lib, baseline = (statistics.median(t) for t in timings.values())
+        print("difference: {:+.3f} ms ({:+.1%})".format((lib - baseline) * 1000, lib / baseline - 1))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+"""
+Compares the key hashing functions of the cached module (key_hash, used by default, and the former pickle_hash) for
+a few typical key shapes.
+
+Usage:
+    python benchmarks/key_hash.py [--number N]
+"""
+
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib"))
+
+from cached import key_hash, make_key, pickle_hash  # noqa: E402
+
+KEYS = {
+    "str": "tt0111161",
+    "int": 278,
+    "bytes": b"\x00" * 64,
+    "decorator key": make_key(("get_details", "movie", 278), {"language": "en-US"}),
+    "nested tuple": ("search", ("action", "drama"), 2, 1.5, None, True),
+    "dict (fallback)": make_key(("discover", {"genres": [28, 18], "page": 3}), {}),
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark cached key hashing")
+    parser.add_argument("--number", type=int, default=100000)
+    args = parser.parse_args()
+
+    print("{:<18} {:>16} {:>16} {:>8}".format("key", "pickle_hash (us)", "key_hash (us)", "speedup"))
+    for name, key in KEYS.items():
+        old = min(timeit.repeat(lambda: pickle_hash(key), number=args.number, repeat=3)) / args.number * 1e6
+        new = min(timeit.repeat(lambda: key_hash(key), number=args.number, repeat=3)) / args.number * 1e6
+        print("{:<18} {:>16.3f} {:>16.3f} {:>7.2f}x".format(name, old, new, old / new))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,30 +1,96 @@
 import os
-import pickle
-import sqlite3
+import io
+import marshal
 import sys
-from base64 import b64encode, b64decode
+import threading
+import time
+from binascii import a2b_base64, b2a_base64, unhexlify
+from collections import OrderedDict
+from collections.abc import Mapping
 from datetime import datetime, timedelta, tzinfo
 from functools import wraps
-from hashlib import sha256
-
-import xbmcaddon
-import xbmcgui
+from hashlib import blake2b, sha256
 
 PY3 = sys.version_info.major >= 3
-if PY3:
-    from xbmcvfs import translatePath
-else:
-    from xbmc import translatePath
 
-ADDON_DATA = translatePath(xbmcaddon.Addon("script.module.cached").getAddonInfo("profile"))
-ADDON = xbmcaddon.Addon()
-ADDON_ID = ADDON.getAddonInfo("id")
-ADDON_VERSION = ADDON.getAddonInfo("version")
 
-if not PY3:
-    ADDON_DATA = ADDON_DATA.decode("utf-8")
-if not os.path.exists(ADDON_DATA):
-    os.makedirs(ADDON_DATA)
+# Kodi modules and addon information are only loaded when first needed, so importing this module is cheap
+def _lazy(func):
+    values = []
+
+    @wraps(func)
+    def wrapper():
+        if not values:
+            values.append(func())
+        return values[0]
+
+    return wrapper
+
+
+def _contextmanager(func):
+    # Same as contextlib.contextmanager, but contextlib is only imported when the context manager is first used
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        from contextlib import contextmanager
+        return contextmanager(func)(*args, **kwargs)
+
+    return wrapper
+
+
+@_lazy
+def get_addon():
+    import xbmcaddon
+    return xbmcaddon.Addon()
+
+
+@_lazy
+def get_addon_id():
+    return get_addon().getAddonInfo("id")
+
+
+@_lazy
+def get_addon_version():
+    return get_addon().getAddonInfo("version")
+
+
+@_lazy
+def get_addon_data():
+    import xbmcaddon
+    if PY3:
+        from xbmcvfs import translatePath
+    else:
+        from xbmc import translatePath
+
+    addon_data = translatePath(xbmcaddon.Addon("script.module.cached").getAddonInfo("profile"))
+    if not PY3:
+        addon_data = addon_data.decode("utf-8")
+    if not os.path.exists(addon_data):
+        os.makedirs(addon_data)
+    return addon_data
+
+
+def _log_error(message):
+    import xbmc
+    xbmc.log("[{}] {}".format(get_addon_id(), message), xbmc.LOGERROR)
+
+
+_LAZY_ATTRIBUTES = {
+    "ADDON": get_addon,
+    "ADDON_ID": get_addon_id,
+    "ADDON_VERSION": get_addon_version,
+    "ADDON_DATA": get_addon_data,
+}
+
+
+def __getattr__(name):
+    try:
+        return _LAZY_ATTRIBUTES[name]()
+    except KeyError:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+# Default identifier, which stands for the running addon version
+_ADDON_VERSION = object()
 
 # Sqlite pragmas, according to https://www.sqlite.org/pragma.html
 SQLITE_SETTINGS = {
@@ -33,6 +99,8 @@ SQLITE_SETTINGS = {
     "cache_size": 8 * 1024,
     "mmap_size": 64 * 1024 * 1024,
     "synchronous": "normal",
+    # Needed for delete triggers to also fire on rows replaced by INSERT OR REPLACE
+    "recursive_triggers": "on",
 }
 
 
@@ -55,6 +123,7 @@ def make_key(args, kwargs, typed=False, kwd_mark=(_KwdMark,), fast_types=(int, s
 
 
 def pickle_hash(obj):
+    import pickle
     data = pickle.dumps(obj)
     # We could also use zlib.adler32 here
     h = sha256()
@@ -62,6 +131,36 @@ def pickle_hash(obj):
     return h.hexdigest()
 
 
+def key_hash(obj, digest_size=16):
+    # Each encoding is tagged, so different keys never share the same data
+    t = type(obj)
+    if t is str:
+        data = b"s" + obj.encode("utf-8", "surrogatepass")
+    elif t is int:
+        data = b"i%d" % obj
+    elif t is bytes:
+        data = b"b" + obj
+    else:
+        # Marshal versions below 3 do not depend on string interning or reference counts, thus they are deterministic
+        try:
+            if t is tuple and _KwdMark in obj:
+                # Keys with keyword arguments (see make_key) have a marker which can not be marshalled
+                i = obj.index(_KwdMark)
+                data = b"k" + marshal.dumps((obj[:i], obj[i + 1:]), 2)
+            else:
+                data = b"m" + marshal.dumps(obj, 2)
+        except (ValueError, TypeError):
+            import pickle
+            data = b"p" + pickle.dumps(obj, 4)
+    return blake2b(data, digest_size=digest_size).hexdigest()
+
+
+def jitter_ttl(ttl, jitter):
+    # Randomly shortens ttl by up to the jitter fraction, so entries set together do not expire together
+    from random import random
+    return ttl - timedelta(seconds=ttl.total_seconds() * jitter * random()) if jitter else ttl
+
+
 class UTC(tzinfo):
     _zero = timedelta(0)
 
@@ -75,30 +174,406 @@ class UTC(tzinfo):
         return self._zero
 
 
+class _LRUCache(object):
+    def __init__(self, max_size):
+        self._max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def max_size(self):
+        return self._max_size
+
+    def get(self, key, default=None, now=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            if entry[1] <= (time.time() if now is None else now):
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, data, expires):
+        with self._lock:
+            self._entries[key] = (data, expires)
+            self._entries.move_to_end(key)
+            self._shrink()
+
+    def resize(self, max_size):
+        with self._lock:
+            self._max_size = max_size
+            self._shrink()
+
+    def pop(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _shrink(self):
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+
+
+# Registered codecs, by name and by the tag stored along with each entry (0 is reserved for _BaseCache._dumps)
+_CODECS = {}
+_CODEC_LOADERS = {}
+
+
+def register_codec(name, tag, dumps, loads):
+    # dumps returns the serialized data as bytes, or None if the value is not supported by the codec
+    if not isinstance(tag, int) or tag <= 0:
+        raise ValueError("Codec tag must be a positive integer")
+    if tag in _CODEC_LOADERS and _CODECS.get(name, (None,))[0] != tag:
+        raise ValueError("Codec tag {} is already registered".format(tag))
+    _CODECS[name] = (tag, dumps)
+    _CODEC_LOADERS[tag] = loads
+
+
+_MARSHAL_SCALARS = frozenset((type(None), bool, int, float, complex, str, bytes))
+_MARSHAL_CONTAINERS = frozenset((tuple, list, set, frozenset))
+
+
+_JSON_SCALARS = frozenset((type(None), bool, int, float, str))
+_JSON_CONTAINERS = frozenset((list,))
+
+
+def _has_only_types(data, scalars, containers, key_types=None):
+    # Checks that data only contains exact instances of the given types (and dicts, with keys of key_types if given)
+    stack = [data]
+    seen = set()
+    while stack:
+        obj = stack.pop()
+        obj_type = type(obj)
+        if obj_type in scalars or id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        if obj_type is dict:
+            if key_types is not None and any(type(k) not in key_types for k in obj):
+                return False
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif obj_type in containers:
+            stack.extend(obj)
+        else:
+            return False
+    return True
+
+
+def _marshal_dumps(data):
+    # marshal silently converts any object supporting the buffer protocol (bytearray, memoryview, array, ...) to
+    # bytes, so values with anything other than the builtin types (including their subclasses) are left to pickle
+    if not _has_only_types(data, _MARSHAL_SCALARS, _MARSHAL_CONTAINERS):
+        return None
+    try:
+        return marshal.dumps(data)
+    except ValueError:
+        return None
+
+
+def _json_dumps(data):
+    import json
+    return json.dumps(data, separators=(",", ":")).encode("utf-8")
+
+
+def _json_loads(data):
+    import json
+    return json.loads(bytes(data).decode("utf-8"))
+
+
+class _LazyMapping(Mapping):
+    # Read only dict whose values are decoded on first access. The data starts with the size of the header, which
+    # holds the keys and the end offsets of their (individually encoded) values
+    def __init__(self, data, loads):
+        import struct
+        header_size = struct.unpack_from("<I", data)[0]
+        keys, self._ends = marshal.loads(data[4:4 + header_size])
+        self._indexes = {key: index for index, key in enumerate(keys)}
+        self._data = memoryview(data)[4 + header_size:]
+        self._loads = loads
+        self._values = {}
+
+    def __getitem__(self, key):
+        try:
+            return self._values[key]
+        except KeyError:
+            pass
+        index = self._indexes[key]
+        start = self._ends[index - 1] if index else 0
+        value = self._values[key] = self._loads(self._data[start:self._ends[index]])
+        return value
+
+    def __iter__(self):
+        return iter(self._indexes)
+
+    def __len__(self):
+        return len(self._indexes)
+
+    def __contains__(self, key):
+        return key in self._indexes
+
+    def __repr__(self):
+        return "{}({!r})".format(type(self).__name__, dict(self))
+
+
+def _dumps_mapping(data, dumps, scalars, containers, key_types=None):
+    import struct
+    # Values which would not be loaded back as they are (such as tuples in JSON) are left to other codecs
+    if type(data) is not dict or not _has_only_types(data, scalars, containers, key_types):
+        return None
+    values = []
+    ends = []
+    end = 0
+    try:
+        for value in data.values():
+            value = dumps(value)
+            values.append(value)
+            end += len(value)
+            ends.append(end)
+    except ValueError:
+        return None
+    header = marshal.dumps((tuple(data), tuple(ends)))
+    return struct.pack("<I", len(header)) + header + b"".join(values)
+
+
+def _pickle_dumps(data):
+    import pickle
+    return pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+
+
+def _pickle_loads(data):
+    import pickle
+    return pickle.loads(data)
+
+
+_BYTES_TAG = 1
+
+register_codec("bytes", _BYTES_TAG, lambda data: data if type(data) is bytes else None, bytes)
+register_codec("str", 2, lambda data: data.encode("utf-8", "surrogatepass") if type(data) is str else None,
+               lambda data: bytes(data).decode("utf-8", "surrogatepass"))
+register_codec("marshal", 3, _marshal_dumps, marshal.loads)
+register_codec("pickle", 4, _pickle_dumps, _pickle_loads)
+
+# dicts whose values can be decoded one by one (see Cache.get_lazy)
+_LAZY_MAPPING_LOADERS = {7: marshal.loads, 8: _json_loads}
+register_codec("marshal_mapping", 7,
+               lambda data: _dumps_mapping(data, marshal.dumps, _MARSHAL_SCALARS, _MARSHAL_CONTAINERS),
+               lambda data: dict(_LazyMapping(data, marshal.loads)))
+register_codec("json_mapping", 8,
+               lambda data: _dumps_mapping(data, _json_dumps, _JSON_SCALARS, _JSON_CONTAINERS, (str,)),
+               lambda data: dict(_LazyMapping(data, _json_loads)))
+
+# marshal is not part of the defaults, as checking the value types makes it slower than pickle for most values
+DEFAULT_CODECS = ("bytes", "str", "pickle")
+
+
+class _LazyValue(object):
+    # Proxy which only loads the value on first use
+    __slots__ = ("_load", "_value")
+
+    def __init__(self, load):
+        self._load = load
+        self._value = None
+
+    def _get_value(self):
+        if self._load is not None:
+            self._value = self._load()
+            self._load = None
+        return self._value
+
+    def __getattr__(self, name):
+        return getattr(self._get_value(), name)
+
+    def __getitem__(self, key):
+        return self._get_value()[key]
+
+    def __contains__(self, item):
+        return item in self._get_value()
+
+    def __iter__(self):
+        return iter(self._get_value())
+
+    def __len__(self):
+        return len(self._get_value())
+
+    def __bool__(self):
+        return bool(self._get_value())
+
+    __nonzero__ = __bool__
+
+    def __eq__(self, other):
+        return self._get_value() == other
+
+    def __ne__(self, other):
+        return self._get_value() != other
+
+    __hash__ = None
+
+    def __str__(self):
+        return str(self._get_value())
+
+    def __repr__(self):
+        return repr(self._get_value())
+
+
+_PICKLE_TAG = 4
+# Pickle data whose large binary objects are stored separately (see Cache buffer_threshold)
+_PICKLE_BUFFERS_TAG = 5
+# The values of pickle.PROTO and pickle.FRAME (pickle is only imported when first needed)
+_PICKLE_FRAME_OPCODES = frozenset((0x80, 0x95))
+# Size from which pickle writes objects on their own (smaller writes are opcodes and frames)
+_PICKLE_FRAME_SIZE = 64 * 1024
+
+
+class _BufferFile(object):
+    # File the pickle data is written to. Pickle writes objects of at least 64 KiB (bytes, bytearray and str objects, as
+    # well as the buffers of objects supporting pickle protocol 5) on their own, straight from the objects, so those of
+    # at least threshold bytes are added to buffers and only their offset is kept, without the need of any per object
+    # hooks. Every other write (the first one, and each frame, starts with the PROTO or FRAME opcodes) is kept as is
+    def __init__(self, threshold, buffers):
+        self.parts = []
+        self.offsets = []
+        self._threshold = max(threshold, _PICKLE_FRAME_SIZE)
+        self._buffers = buffers
+        self._size = 0
+
+    def write(self, b):
+        buffer = memoryview(b)
+        if buffer.nbytes >= self._threshold and buffer.c_contiguous:
+            buffer = buffer.cast("B")
+            if buffer[0] not in _PICKLE_FRAME_OPCODES:
+                self.offsets.append(self._size)
+                self._buffers.append(buffer)
+                return buffer.nbytes
+        self.parts.append(b)
+        self._size += buffer.nbytes
+        return buffer.nbytes
+
+
+class _SplicedReader(io.RawIOBase):
+    # Reads file with each of the buffers (which are files as well) inserted at its offset
+    def __init__(self, file, offsets, buffers):
+        super(_SplicedReader, self).__init__()
+        self._file = file
+        self._offsets = offsets
+        self._buffers = buffers
+        self._position = 0
+        self._index = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while self._index < len(self._offsets) and self._offsets[self._index] == self._position:
+            n = self._buffers[self._index].readinto(b)
+            if n:
+                return n
+            self._index += 1
+        if self._index < len(self._offsets):
+            b = memoryview(b)[:self._offsets[self._index] - self._position]
+        n = self._file.readinto(b)
+        self._position += n
+        return n
+
+
+def _dumps_buffers(data, threshold, buffers):
+    # Unless no objects were added to buffers, the pickle data is preceded by their offsets
+    import pickle
+    import struct
+    file = _BufferFile(threshold, buffers)
+    pickle.Pickler(file, pickle.HIGHEST_PROTOCOL).dump(data)
+    if not file.offsets:
+        return _PICKLE_TAG, b"".join(file.parts)
+    header = struct.pack("<I{}Q".format(len(file.offsets)), len(file.offsets), *file.offsets)
+    return _PICKLE_BUFFERS_TAG, b"".join([header] + file.parts)
+
+
+def _load_buffers(file, buffers):
+    import pickle
+    import struct
+    count = struct.unpack("<I", file.read(4))[0]
+    offsets = struct.unpack("<{}Q".format(count), file.read(8 * count))
+    with io.BufferedReader(_SplicedReader(file, offsets, buffers)) as reader:
+        return pickle.load(reader)
+
+
+_CODEC_LOADERS[_PICKLE_BUFFERS_TAG] = lambda data: _load_buffers(io.BytesIO(data), ())
+
+
 class _BaseCache(object):
     __instance = None
+    __lock = threading.Lock()
 
     _timezone = UTC()
+    _codecs = ()
 
     @classmethod
     def get_instance(cls):
         if cls.__instance is None:
-            cls.__instance = cls()
+            with cls.__lock:
+                if cls.__instance is None:
+                    cls.__instance = cls()
         return cls.__instance
 
-    def get(self, key, default=None, hashed_key=False, identifier=ADDON_VERSION):
-        return self._get(self._generate_key(key, hashed_key=hashed_key, identifier=identifier), default=default)
+    def get(self, key, default=None, hashed_key=False, identifier=_ADDON_VERSION):
+        return self._get(
+            self._generate_key(key, hashed_key=hashed_key, identifier=identifier, create=False), default=default)
+
+    def get_lazy(self, key, default=None, hashed_key=False, identifier=_ADDON_VERSION):
+        return self._get_lazy(
+            self._generate_key(key, hashed_key=hashed_key, identifier=identifier, create=False), default=default)
+
+    def set(self, key, data, ttl, hashed_key=False, identifier=_ADDON_VERSION, jitter=0):
+        return self._set(
+            self._generate_key(key, hashed_key=hashed_key, identifier=identifier), data, jitter_ttl(ttl, jitter))
 
-    def set(self, key, data, ttl, hashed_key=False, identifier=ADDON_VERSION):
-        return self._set(self._generate_key(key, hashed_key=hashed_key, identifier=identifier), data, ttl)
+    def remove(self, key, hashed_key=False, identifier=_ADDON_VERSION):
+        return self._remove(self._generate_key(key, hashed_key=hashed_key, identifier=identifier, create=False))
 
-    def remove(self, key, hashed_key=False, identifier=ADDON_VERSION):
-        return self._remove(self._generate_key(key, hashed_key=hashed_key, identifier=identifier))
+    def get_many(self, keys, default=None, hashed_key=False, identifier=_ADDON_VERSION):
+        keys = list(keys)
+        values = self._get_many([self._generate_key(k, hashed_key=hashed_key, identifier=identifier, create=False)
+                                 for k in keys], default=default)
+        return dict(zip(keys, values))
+
+    def set_many(self, mapping, ttl, hashed_key=False, identifier=_ADDON_VERSION, jitter=0):
+        # Each entry gets its own jitter, so entries set together do not expire together
+        return self._set_many([(self._generate_key(k, hashed_key=hashed_key, identifier=identifier), v,
+                                jitter_ttl(ttl, jitter)) for k, v in mapping.items()])
+
+    def remove_many(self, keys, hashed_key=False, identifier=_ADDON_VERSION):
+        return self._remove_many(
+            [self._generate_key(k, hashed_key=hashed_key, identifier=identifier, create=False) for k in keys])
+
+    def acquire_lease(self, key, ttl, hashed_key=False, identifier=_ADDON_VERSION):
+        from uuid import uuid4
+        owner = "{}.{}".format(os.getpid(), uuid4().hex)
+        if self._acquire_lease(self._generate_key(key, hashed_key=hashed_key, identifier=identifier), owner, ttl):
+            return owner
+        return None
+
+    def release_lease(self, key, owner, hashed_key=False, identifier=_ADDON_VERSION):
+        return self._release_lease(
+            self._generate_key(key, hashed_key=hashed_key, identifier=identifier, create=False), owner)
+
+    @_contextmanager
+    def batch(self):
+        yield self
+
+    def enable_front_cache(self, max_size):
+        pass
 
     def close(self):
         pass
 
-    def _generate_key(self, key, hashed_key=False, identifier=""):
+    def _generate_key(self, key, hashed_key=False, identifier="", create=True):
+        # create is false for keys which are only read, which do not need to be registered anywhere
+        if identifier is _ADDON_VERSION:
+            identifier = get_addon_version()
         if not hashed_key:
             key = self._hash(key)
         if identifier:
@@ -108,17 +583,48 @@ class _BaseCache(object):
     def _now(self):
         return datetime.now(self._timezone)
 
+    def _set_codecs(self, codecs):
+        if codecs is None:
+            # Subclasses with their own serializer keep using it
+            codecs = DEFAULT_CODECS if type(self)._dumps is _BaseCache._dumps else ()
+        for name in codecs:
+            if name not in _CODECS:
+                raise ValueError("Unknown codec: {}".format(name))
+        self._codecs = tuple(_CODECS[name] for name in codecs)
+
+    def _serialize(self, data, buffers=None, buffer_threshold=None):
+        for tag, dumps in self._codecs:
+            if tag == _PICKLE_TAG and buffers is not None:
+                # Large objects of at least buffer_threshold bytes are added to buffers instead of being serialized
+                return _dumps_buffers(data, buffer_threshold, buffers)
+            serialized = dumps(data)
+            if serialized is not None:
+                return tag, serialized
+        return 0, self._dumps(data)
+
+    def _deserialize(self, tag, data, buffers=None):
+        if not tag:
+            return self._loads(data)
+        if tag == _PICKLE_BUFFERS_TAG:
+            return _load_buffers(io.BytesIO(data), buffers)
+        loads = _CODEC_LOADERS.get(tag)
+        if loads is None:
+            raise ValueError("Unknown codec tag: {}".format(tag))
+        return loads(data)
+
     @staticmethod
     def _loads(data):
+        import pickle
         return pickle.loads(data)
 
     @staticmethod
     def _dumps(data):
+        import pickle
         return pickle.dumps(data)
 
     @staticmethod
     def _hash(data):
-        return pickle_hash(data)
+        return key_hash(data)
 
     def _get(self, key, default=None):
         raise NotImplementedError("_get needs to be implemented")
@@ -129,69 +635,1050 @@ class _BaseCache(object):
     def _remove(self, key):
         raise NotImplementedError("_remove needs to be implemented")
 
+    def _get_lazy(self, key, default=None):
+        return self._get(key, default=default)
+
+    def _get_many(self, keys, default=None):
+        return [self._get(key, default=default) for key in keys]
+
+    def _set_many(self, items):
+        for key, data, ttl in items:
+            self._set(key, data, ttl)
+
+    def _remove_many(self, keys):
+        for key in keys:
+            self._remove(key)
+
+    # Leases are only enforced across processes by caches which support them
+    def _acquire_lease(self, key, owner, ttl):
+        return True
+
+    def _release_lease(self, key, owner):
+        pass
+
 
 class MemoryCache(_BaseCache):
-    def __init__(self, database=ADDON_ID):
+    def __init__(self, database=None, codecs=None):
+        import xbmcgui
         self._window = xbmcgui.Window(10000)
-        self._database = database
+        self._database = get_addon_id() if database is None else database
+        self._set_codecs(codecs)
 
-    def _generate_key(self, key, hashed_key=False, identifier=""):
+    def _generate_key(self, key, hashed_key=False, identifier="", create=True):
         return self._database + "." + super(MemoryCache, self)._generate_key(
-            key, hashed_key=hashed_key, identifier=identifier)
+            key, hashed_key=hashed_key, identifier=identifier, create=create)
 
     def _get(self, key, default=None):
-        b64_data = self._window.getProperty(key)
-        if b64_data:
-            data, expires = self._loads(b64decode(b64_data))
-            if expires <= self._now():
-                self._remove(key)
-                data = default
-        else:
-            data = default
-        return data
+        return self._get_property(key, time.time(), default)
 
     def _set(self, key, data, ttl):
-        self._window.setProperty(key, b64encode(self._dumps((data, self._now() + ttl))).decode())
+        self._set_property(key, data, time.time() + ttl.total_seconds())
+
+    def _get_many(self, keys, default=None):
+        now = time.time()
+        return [self._get_property(key, now, default) for key in keys]
+
+    def _set_many(self, items):
+        now = time.time()
+        for key, data, ttl in items:
+            self._set_property(key, data, now + ttl.total_seconds())
+
+    def _set_property(self, key, data, expires):
+        # Properties are stored as "<codec tag>:<expires>:<base64 data>"
+        tag, data = self._serialize(data)
+        self._window.setProperty(key, "{}:{!r}:{}".format(tag, expires, b2a_base64(data, newline=False).decode()))
+
+    def _get_property(self, key, now, default):
+        value = self._window.getProperty(key)
+        if not value:
+            return default
+        if ":" in value:
+            tag, expires, b64_data = value.split(":", 2)
+            if float(expires) > now:
+                return self._deserialize(int(tag), a2b_base64(b64_data))
+        else:
+            # Properties set before codecs were introduced hold a pickled (data, expires datetime) tuple
+            data, expires = self._loads(a2b_base64(value))
+            if expires > self._now():
+                return data
+        self._remove(key)
+        return default
 
     def _remove(self, key):
         self._window.clearProperty(key)
 
 
+def _encode_key(key):
+    # Lowercase hexadecimal keys (such as the ones generated by key_hash) are stored as binary digests. Any other key is
+    # stored as text, which sqlite never considers equal to a blob, so different keys never share the same row
+    try:
+        data = unhexlify(key)
+    except (ValueError, TypeError):
+        return key
+    return data if data.hex() == key else key
+
+
+def _migrate_binary_keys(conn):
+    conn.execute("CREATE TABLE `identifiers` (id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL)")
+    conn.execute(
+        "CREATE TABLE `cached_new` ("
+        "identifier INTEGER NOT NULL, "
+        "key BLOB NOT NULL, "
+        "data BLOB NOT NULL, "
+        "expires REAL NOT NULL, "
+        "size INTEGER NOT NULL DEFAULT 0, "
+        "accessed REAL NOT NULL DEFAULT 0, "
+        "hits INTEGER NOT NULL DEFAULT 0, "
+        "PRIMARY KEY (identifier, key)"
+        ") WITHOUT ROWID")
+    identifier_ids = {}
+    cursor = conn.execute("SELECT key, data, expires, size, accessed, hits FROM `cached`")
+    while True:
+        rows = []
+        for key, data, expires, size, accessed, hits in cursor.fetchmany(500):
+            identifier, _, key = key.rpartition(".")
+            identifier_id = identifier_ids.get(identifier)
+            if identifier_id is None:
+                conn.execute("INSERT OR IGNORE INTO `identifiers` (name) VALUES(?)", (identifier,))
+                identifier_id = identifier_ids[identifier] = conn.execute(
+                    "SELECT id FROM `identifiers` WHERE name = ?", (identifier,)).fetchone()[0]
+            rows.append((identifier_id, _encode_key(key), data, expires, size, accessed, hits))
+        if not rows:
+            break
+        conn.executemany(
+            "INSERT OR REPLACE INTO `cached_new` (identifier, key, data, expires, size, accessed, hits) "
+            "VALUES(?, ?, ?, ?, ?, ?, ?)", rows)
+    conn.execute("DROP TABLE `cached`")
+    conn.execute("ALTER TABLE `cached_new` RENAME TO `cached`")
+    conn.execute("CREATE INDEX `cached_expires_idx` ON `cached` (expires)")
+    conn.execute("DROP TABLE `leases`")
+    conn.execute(
+        "CREATE TABLE `leases` ("
+        "identifier INTEGER NOT NULL, "
+        "key BLOB NOT NULL, "
+        "owner TEXT NOT NULL, "
+        "expires REAL NOT NULL, "
+        "PRIMARY KEY (identifier, key)"
+        ") WITHOUT ROWID")
+
+
+# Compression modules (all of them provide compress/decompress functions), by the id stored in each row
+_COMPRESSIONS = {1: "zlib", 2: "lzma", 3: "bz2"}
+_COMPRESSION_IDS = {v: k for k, v in _COMPRESSIONS.items()}
+# zlib compression with a preset dictionary, trained from the stored values (see Cache.train_zdict)
+_ZDICT = 4
+
+
+class _MissingZdict(Exception):
+    # Raised when the dictionary an entry was compressed with no longer exists, which makes the entry a miss
+    pass
+
+
+def _train_zdict(samples, size, length=8, max_grams=100000):
+    # Count in how many samples each substring of the given length appears (once max_grams substrings are counted,
+    # only those keep being counted, which bounds memory usage on data without much in common)
+    counts = {}
+    for sample in samples:
+        for gram in {sample[i:i + length] for i in range(len(sample) - length + 1)}:
+            count = counts.get(gram)
+            if count is not None:
+                counts[gram] = count + 1
+            elif len(counts) < max_grams:
+                counts[gram] = 1
+    min_count = max(2, len(samples) // 10)
+    # Consecutive frequent substrings are merged into segments (e.g. whole dictionary keys), which are then ranked by
+    # the number of bytes they would save
+    segments = {}
+    for sample in samples:
+        found = set()
+        start = None
+        for i in range(len(sample) - length + 2):
+            frequent = i <= len(sample) - length and counts.get(sample[i:i + length], 0) >= min_count
+            if frequent and start is None:
+                start = i
+            elif not frequent and start is not None:
+                found.add(sample[start:i - 1 + length])
+                start = None
+        for segment in found:
+            segments[segment] = segments.get(segment, 0) + 1
+    zdict = b""
+    for segment in sorted(segments, key=lambda s: segments[s] * len(s), reverse=True):
+        if len(zdict) + len(segment) > size:
+            break
+        if segment not in zdict:
+            # zlib finds recent data with shorter distances, so the most valuable segments go last
+            zdict = segment + zdict
+    return zdict
+
+
+def _release_connection(connections, lock, conn):
+    with lock:
+        if conn in connections:
+            connections.remove(conn)
+            conn.close()
+
+
+def _flush_accesses_at_exit(cache_ref):
+    import sqlite3
+    cache = cache_ref()
+    if cache is not None:
+        try:
+            cache._flush_accesses()
+        except sqlite3.Error as e:
+            _log_error("Failed to store cache accesses: {}".format(e))
+
+
+class _ConnectionHolder(object):
+    # Holds the connection of a thread, which is released once the thread exits (as its thread local data is dropped)
+    __slots__ = ("conn", "__weakref__")
+
+    def __init__(self, conn):
+        self.conn = conn
+
+
+class _BlobReader(io.RawIOBase):
+    # Reads the given blobs, in order, as a single file. The connection must hold a read transaction, so the blobs can
+    # not change while being read. If cache is given, the connection belongs to the reader and is closed with it
+
+    # Maximum size of each read, as the data goes through a temporary copy
+    _max_read = 64 * 1024
+
+    def __init__(self, conn, blobs, cache=None):
+        super(_BlobReader, self).__init__()
+        self._conn = conn
+        self._cache = cache
+        self._ids = []
+        self._starts = []
+        self._size = 0
+        for blob_id, length in blobs:
+            self._ids.append(blob_id)
+            self._starts.append(self._size)
+            self._size += length
+        self._position = 0
+        self._blob = None
+        self._blob_index = None
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self._size
+        if offset < 0:
+            raise ValueError("Negative seek position {}".format(offset))
+        self._position = offset
+        return offset
+
+    def readinto(self, b):
+        from bisect import bisect_right
+        if self._position >= self._size:
+            return 0
+        index = bisect_right(self._starts, self._position) - 1
+        offset = self._position - self._starts[index]
+        end = self._starts[index + 1] if index + 1 < len(self._starts) else self._size
+        length = min(len(b), end - self._position, self._max_read)
+        if hasattr(self._conn, "blobopen"):
+            if self._blob_index != index:
+                if self._blob is not None:
+                    self._blob.close()
+                self._blob = self._conn.blobopen("blobs", "data", self._ids[index], readonly=True)
+                self._blob_index = index
+            self._blob.seek(offset)
+            data = self._blob.read(length)
+        else:
+            data = self._conn.execute("SELECT SUBSTR(data, ?, ?) FROM `blobs` WHERE id = ?",
+                                      (offset + 1, length, self._ids[index])).fetchone()[0]
+        b[:len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            if self._cache is not None:
+                # Closing the connection also closes the blob and ends the read transaction
+                self._cache._close_connection(self._conn)
+            elif self._blob is not None:
+                self._blob.close()
+        super(_BlobReader, self).close()
+
+
+class _BlobWriter(io.RawIOBase):
+    # Spools the written data, which is only stored on an explicit close (unless closed because of an exception)
+    def __init__(self, cache, key, ttl, spool_size):
+        super(_BlobWriter, self).__init__()
+        self._cache = cache
+        self._key = key
+        self._ttl = ttl
+        import tempfile
+        self._spool = tempfile.SpooledTemporaryFile(max_size=spool_size)
+        self._discard = False
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        return self._spool.write(b)
+
+    def discard(self):
+        self._discard = True
+        self.close()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self._discard = True
+        return super(_BlobWriter, self).__exit__(exc_type, exc_value, traceback)
+
+    def __del__(self):
+        # Writers which are never closed (for instance, because the producer raised) may hold partial data
+        self._discard = True
+        super(_BlobWriter, self).__del__()
+
+    def close(self):
+        if not self.closed:
+            try:
+                if not self._discard:
+                    self._cache._store_stream(self._key, self._spool, self._ttl)
+            finally:
+                self._spool.close()
+        super(_BlobWriter, self).close()
+
+
 class Cache(_BaseCache):
-    def __init__(self, database=os.path.join(ADDON_DATA, ADDON_ID + ".cached.sqlite"),
-                 cleanup_interval=timedelta(minutes=15)):
-        self._conn = sqlite3.connect(
-            database, detect_types=sqlite3.PARSE_DECLTYPES, isolation_level=None, check_same_thread=False)
-        self._conn.execute(
-            "CREATE TABLE IF NOT EXISTS `cached` ("
+    # Keep below the default SQLITE_MAX_VARIABLE_NUMBER of older sqlite versions (999)
+    _max_variables = 900
+    # Schema migrations, where the statements at index i upgrade the database from version i to version i + 1
+    _migrations = (
+        (
+            "CREATE TABLE `cached_new` ("
             "key TEXT PRIMARY KEY NOT NULL, "
             "data BLOB NOT NULL, "
-            "expires TEXT NOT NULL"
-            ")")
-        # self._conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS key_idx ON `{}` (key)'.format(self._table_name))
-        for k, v in SQLITE_SETTINGS.items():
-            self._conn.execute("PRAGMA {}={}".format(k, v))
+            "expires REAL NOT NULL"
+            ")",
+            "INSERT INTO `cached_new` (key, data, expires) "
+            "SELECT key, data, (JULIANDAY(expires) - 2440587.5) * 86400.0 FROM `cached`",
+            "DROP TABLE `cached`",
+            "ALTER TABLE `cached_new` RENAME TO `cached`",
+            "CREATE INDEX `cached_expires_idx` ON `cached` (expires)",
+        ),
+        (
+            "ALTER TABLE `cached` ADD COLUMN size INTEGER NOT NULL DEFAULT 0",
+            "ALTER TABLE `cached` ADD COLUMN accessed REAL NOT NULL DEFAULT 0",
+            "ALTER TABLE `cached` ADD COLUMN hits INTEGER NOT NULL DEFAULT 0",
+            "UPDATE `cached` SET size = LENGTH(data)",
+        ),
+        (
+            "CREATE TABLE `leases` ("
+            "key TEXT PRIMARY KEY NOT NULL, "
+            "owner TEXT NOT NULL, "
+            "expires REAL NOT NULL"
+            ")",
+        ),
+        (
+            # Keys are stored as binary digests and identifiers as integers (from the identifiers table)
+            _migrate_binary_keys,
+        ),
+        (
+            "ALTER TABLE `cached` ADD COLUMN compression INTEGER NOT NULL DEFAULT 0",
+        ),
+        (
+            "CREATE TABLE `zdicts` ("
+            "id INTEGER PRIMARY KEY, "
+            "data BLOB NOT NULL, "
+            "created REAL NOT NULL"
+            ")",
+            "ALTER TABLE `cached` ADD COLUMN zdict INTEGER NOT NULL DEFAULT 0",
+        ),
+        (
+            "ALTER TABLE `cached` ADD COLUMN format INTEGER NOT NULL DEFAULT 0",
+        ),
+        (
+            # Data stored outside of the cached rows (such as out of band pickle buffers), deleted along with them
+            "CREATE TABLE `blobs` ("
+            "id INTEGER PRIMARY KEY, "
+            "identifier INTEGER NOT NULL, "
+            "key BLOB NOT NULL, "
+            "idx INTEGER NOT NULL, "
+            "data BLOB NOT NULL"
+            ")",
+            "CREATE INDEX `blobs_key_idx` ON `blobs` (identifier, key, idx)",
+            "CREATE TRIGGER `cached_blobs_delete` AFTER DELETE ON `cached` WHEN OLD.format = {} BEGIN "
+            "DELETE FROM `blobs` WHERE identifier = OLD.identifier AND key = OLD.key; "
+            "END".format(_PICKLE_BUFFERS_TAG),
+        ),
+        (
+            # Number of blobs of each entry, so the trigger applies to any kind of entry with blobs, and number of
+            # those which hold the data of the entry (the remaining ones, if any, hold its pickle buffers)
+            "ALTER TABLE `cached` ADD COLUMN blobs INTEGER NOT NULL DEFAULT 0",
+            "ALTER TABLE `cached` ADD COLUMN chunks INTEGER NOT NULL DEFAULT 0",
+            "UPDATE `cached` SET blobs = (SELECT COUNT(*) FROM `blobs` AS b "
+            "WHERE b.identifier = `cached`.identifier AND b.key = `cached`.key) WHERE format = {}".format(
+                _PICKLE_BUFFERS_TAG),
+            "DROP TRIGGER `cached_blobs_delete`",
+            "CREATE TRIGGER `cached_blobs_delete` AFTER DELETE ON `cached` WHEN OLD.blobs > 0 BEGIN "
+            "DELETE FROM `blobs` WHERE identifier = OLD.identifier AND key = OLD.key; "
+            "END",
+        ),
+    )
+    _eviction_orders = {"lru": "accessed", "lfu": "hits, accessed"}
+    # Number of writes after which the size limits are checked
+    _eviction_check_writes = 64
+    # Number of entries whose accesses are kept in memory before being written to the database
+    _max_pending_accesses = 256
+    # Fraction of the limits to shrink to when evicting, so evictions happen in batches
+    _eviction_target = 0.9
+    # Maximum number of expired entries deleted per transaction by the background clean up
+    _cleanup_chunk_size = 500
+    # Maximum size of the trained compression dictionaries, and number of stored values sampled to train them
+    _zdict_size = 16 * 1024
+    _zdict_samples = 200
+    _zdict_min_samples = 20
+    # Minimum time between background trainings which did not produce a dictionary
+    _zdict_retry_interval = timedelta(days=1)
+    # Time after which dictionaries replaced by a newer one may be removed
+    _zdict_prune_delay = timedelta(days=1)
+    # Entries smaller than this are loaded right away by get_lazy
+    _lazy_min_size = 16
+    # Size of the blobs large values and streamed entries are split into
+    _chunk_size = 1024 * 1024
+    # Size of the reads and writes made on blobs while streaming
+    _stream_buffer_size = 64 * 1024
+
+    def __init__(self, database=None,
+                 cleanup_interval=timedelta(minutes=15), max_entries=None, max_size_bytes=None, eviction_policy="lru",
+                 front_cache_size=0, background_cleanup=False, compression=None, compression_threshold=1024,
+                 codecs=None, buffer_threshold=None, chunk_threshold=4 * 1024 * 1024):
+        if eviction_policy not in self._eviction_orders:
+            raise ValueError("Unknown eviction policy: {}".format(eviction_policy))
+        if compression is not None and compression != "zdict" and compression not in _COMPRESSION_IDS:
+            raise ValueError("Unknown compression: {}".format(compression))
+        # The database is only opened (and cleaned up) on the first cache operation. Each thread then gets its own
+        # connection, which allows concurrent reads when using WAL
+        self._database = database
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.RLock()
+        self._initialized = False
+        self._identifier_ids = {}
+        self._set_codecs(codecs)
+        self._buffer_threshold = buffer_threshold
+        self._chunk_threshold = chunk_threshold
+        self._compression = compression
+        self._compression_threshold = compression_threshold
+        self._zdicts = {}
+        self._zdict_id = None
+        self._max_entries = max_entries
+        self._max_size_bytes = max_size_bytes
+        self._eviction_order = self._eviction_orders[eviction_policy]
+        self._writes = 0
+        self._accesses = {}
+        if self.bounded:
+            # Accesses still in memory are written when the process exits (unless the cache was collected before)
+            import atexit
+            import weakref
+            atexit.register(_flush_accesses_at_exit, weakref.ref(self))
+        self._front_cache = None
+        self._sentinel = object()
+        self.enable_front_cache(front_cache_size)
         self._cleanup_interval = cleanup_interval
         self._last_cleanup = self._now()
-        self.clean_up()
+        self._background_cleanup = background_cleanup
+        self._cleanup_thread = None
+        self._stop_cleanup = threading.Event()
+
+    @property
+    def _conn(self):
+        holder = getattr(self._local, "holder", None)
+        if holder is None:
+            return self._connect()
+        return holder.conn
+
+    def _connect(self):
+        import weakref
+        with self._connections_lock:
+            conn = self._open_connection()
+            holder = self._local.holder = _ConnectionHolder(conn)
+            # The finalizer does not reference the cache, so caches which are not closed can still be collected
+            finalizer = weakref.finalize(holder, _release_connection, self._connections, self._connections_lock, conn)
+            # Connections are left open at exit, so they can still be used by exit handlers
+            finalizer.atexit = False
+            if not self._initialized:
+                self._initialized = True
+                self._migrate()
+                if self._background_cleanup:
+                    self._stop_cleanup.clear()
+                    self._cleanup_thread = threading.Thread(target=self._cleanup_loop, name="cached-cleanup")
+                    self._cleanup_thread.daemon = True
+                    self._cleanup_thread.start()
+                else:
+                    self.clean_up()
+        return conn
+
+    def _open_connection(self):
+        import sqlite3
+        with self._connections_lock:
+            if self._database is None:
+                self._database = os.path.join(get_addon_data(), get_addon_id() + ".cached.sqlite")
+            # Connections are only used by the thread which created them, but they are closed by any thread on close
+            conn = sqlite3.connect(
+                self._database, detect_types=sqlite3.PARSE_DECLTYPES, isolation_level=None, check_same_thread=False)
+            for k, v in SQLITE_SETTINGS.items():
+                conn.execute("PRAGMA {}={}".format(k, v))
+            self._connections.append(conn)
+        return conn
+
+    def _close_connection(self, conn):
+        _release_connection(self._connections, self._connections_lock, conn)
+
+    def _cleanup_loop(self):
+        import sqlite3
+        while not self._stop_cleanup.is_set():
+            try:
+                self._delete_expired(self._conn, self._cleanup_chunk_size, self._stop_cleanup)
+                self._check_zdict(train=True)
+                self._last_cleanup = self._now()
+            except sqlite3.Error as e:
+                # Errors such as the database being locked by another process are retried on the next interval
+                _log_error("Background clean up failed: {}".format(e))
+            self._stop_cleanup.wait(self._cleanup_interval.total_seconds())
+
+    def _delete_expired(self, conn, chunk_size=None, stop_event=None):
+        now = time.time()
+        conn.execute("DELETE FROM `leases` WHERE expires <= ?", (now,))
+        if chunk_size is None:
+            return conn.execute("DELETE FROM `cached` WHERE expires <= ?", (now,)).rowcount
+        deleted = 0
+        while stop_event is None or not stop_event.is_set():
+            # Each chunk is deleted in its own transaction, so writers are never blocked for long
+            count = conn.execute(
+                "DELETE FROM `cached` WHERE (identifier, key) IN "
+                "(SELECT identifier, key FROM `cached` WHERE expires <= ? LIMIT ?)", (now, chunk_size)).rowcount
+            deleted += count
+            if count < chunk_size:
+                break
+        return deleted
 
     def _get(self, key, default=None):
         self.check_clean_up()
+        now = time.time()
+        if self._front_cache is not None:
+            data = self._front_cache.get(key, self._sentinel, now)
+            if data is not self._sentinel:
+                self._track_access(key, now)
+                return data
         row = self._conn.execute(
-            "SELECT data FROM `cached` WHERE key = ? AND expires > STRFTIME('%Y-%m-%d %H:%M:%f', 'NOW')",
-            (key,)).fetchone()
-        return default if row is None else self._loads(row[0])
+            "SELECT data, format, compression, zdict, expires, blobs FROM `cached` "
+            "WHERE identifier = ? AND key = ? AND expires > ?", key + (now,)).fetchone()
+        if row is not None:
+            try:
+                row = self._get_with_blobs(key, now) if row[5] else (row[4], self._decode(*row[:4]))
+            except _MissingZdict:
+                row = None
+        if row is None:
+            return default
+        self._track_access(key, now)
+        expires, data = row
+        # Rows read inside a transaction may not be committed yet (and thus may be rolled back), so they are not kept
+        if self._front_cache is not None and not self._conn.in_transaction:
+            self._front_cache.set(key, data, expires)
+        return data
+
+    def _get_with_blobs(self, key, now):
+        # The entry is read again, along with its blobs, from the same snapshot, so they always match
+        with self._snapshot():
+            row = self._conn.execute(
+                "SELECT data, format, compression, zdict, expires, chunks FROM `cached` "
+                "WHERE identifier = ? AND key = ? AND expires > ?", key + (now,)).fetchone()
+            if row is None:
+                return None
+            data, data_format, compression, zdict_id, expires, chunks = row
+            blobs = self._conn.execute(
+                "SELECT id, LENGTH(data) FROM `blobs` WHERE identifier = ? AND key = ? ORDER BY idx", key).fetchall()
+            # Pickle buffers are read straight from their blobs into the loaded objects
+            buffers = [_BlobReader(self._conn, [blob]) for blob in blobs[chunks:]]
+            try:
+                if not chunks:
+                    return expires, self._decode(data, data_format, compression, zdict_id, buffers)
+                with io.BufferedReader(_BlobReader(self._conn, blobs[:chunks]), self._stream_buffer_size) as reader:
+                    if compression or data_format not in (_PICKLE_TAG, _PICKLE_BUFFERS_TAG):
+                        return expires, self._decode(reader.read(), data_format, compression, zdict_id, buffers)
+                    # Pickled data is loaded straight from the blobs, without joining them first
+                    if data_format == _PICKLE_TAG:
+                        import pickle
+                        return expires, pickle.load(reader)
+                    return expires, _load_buffers(reader, buffers)
+            finally:
+                for buffer in buffers:
+                    buffer.close()
+
+    def _get_lazy(self, key, default=None):
+        self.check_clean_up()
+        now = time.time()
+        # Entries already in memory are returned as they are
+        if self._front_cache is not None and self._front_cache.get(key, self._sentinel, now) is not self._sentinel:
+            return self._get(key, default)
+        row = self._conn.execute(
+            "SELECT data, format, compression, zdict, blobs FROM `cached` "
+            "WHERE identifier = ? AND key = ? AND expires > ?", key + (now,)).fetchone()
+        if row is None:
+            return default
+        # Entries with blobs are read from a snapshot, so they are loaded right away (chunks are read lazily anyway)
+        if row[4]:
+            return self._get(key, default)
+        data, data_format, compression, zdict_id = row[:4]
+        if compression == _ZDICT:
+            # The dictionary is loaded right away, so entries which can not be decompressed are misses
+            try:
+                self._get_zdict(zdict_id)
+            except _MissingZdict:
+                return default
+        self._track_access(key, now)
+        # Small values (such as None, so that "is None" checks work) are cheap to decode and returned as they are
+        if len(data) < self._lazy_min_size:
+            return self._decode(data, data_format, compression, zdict_id)
+        if data_format in _LAZY_MAPPING_LOADERS:
+            return _LazyMapping(self._decompress(data, compression, zdict_id), _LAZY_MAPPING_LOADERS[data_format])
+        return _LazyValue(lambda: self._decode(data, data_format, compression, zdict_id))
+
+    @_contextmanager
+    def _snapshot(self):
+        # Consecutive reads made inside see the same data (any transaction already open is used as is)
+        if self._conn.in_transaction:
+            yield
+            return
+        self._conn.execute("BEGIN")
+        try:
+            yield
+        finally:
+            self._conn.execute("COMMIT")
 
     def _set(self, key, data, ttl):
         self.check_clean_up()
-        self._conn.execute(
-            "INSERT OR REPLACE INTO `cached` (key, data, expires) "
-            "VALUES(?, ?, STRFTIME('%Y-%m-%d %H:%M:%f', 'NOW', ?))",
-            (key, sqlite3.Binary(self._dumps(data)), "+{:.3f} seconds".format(ttl.total_seconds())))
+        now = time.time()
+        row, buffers = self._encode(key, data, now + ttl.total_seconds(), now)
+        if buffers:
+            with self.batch():
+                self._insert([row], buffers)
+        else:
+            self._insert([row], buffers)
+        if self._front_cache is not None:
+            self._front_cache.pop(key)
+        self._check_evict(1)
+
+    def _insert(self, rows, buffers):
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO `cached` "
+            "(identifier, key, data, format, compression, zdict, expires, size, accessed, blobs, chunks) "
+            "VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        # Blobs of the replaced entries were deleted along with them (by the cached_blobs_delete trigger)
+        if buffers:
+            self._conn.executemany("INSERT INTO `blobs` (identifier, key, idx, data) VALUES(?, ?, ?, ?)", buffers)
 
     def _remove(self, key):
         self.check_clean_up()
-        self._conn.execute("DELETE FROM `cached` WHERE key = ?", (key,))
+        self._conn.execute("DELETE FROM `cached` WHERE identifier = ? AND key = ?", key)
+        self._accesses.pop(key, None)
+        if self._front_cache is not None:
+            self._front_cache.pop(key)
+
+    def _get_many(self, keys, default=None):
+        self.check_clean_up()
+        found = {}
+        now = time.time()
+        missing = []
+        for key in set(keys):
+            data = self._sentinel if self._front_cache is None else self._front_cache.get(key, self._sentinel, now)
+            if data is self._sentinel:
+                missing.append(key)
+            else:
+                found[key] = data
+        for identifier, chunk in self._chunk_keys(missing):
+            for key, data, data_format, compression, zdict, expires, blobs in self._conn.execute(
+                    "SELECT key, data, format, compression, zdict, expires, blobs FROM `cached` "
+                    "WHERE identifier = ? AND key IN ({}) AND expires > ?".format(", ".join("?" * len(chunk))),
+                    [identifier] + chunk + [now]):
+                key = (identifier, key)
+                try:
+                    if blobs:
+                        row = self._get_with_blobs(key, now)
+                        if row is None:
+                            continue
+                        expires, data = row
+                    else:
+                        data = self._decode(data, data_format, compression, zdict)
+                except _MissingZdict:
+                    continue
+                found[key] = data
+                if self._front_cache is not None and not self._conn.in_transaction:
+                    self._front_cache.set(key, data, expires)
+        for key in found:
+            self._track_access(key, now)
+        return [found.get(key, default) for key in keys]
+
+    def _set_many(self, items):
+        self.check_clean_up()
+        now = time.time()
+        rows = []
+        buffers = []
+        for key, data, ttl in items:
+            row, row_buffers = self._encode(key, data, now + ttl.total_seconds(), now)
+            rows.append(row)
+            buffers.extend(row_buffers)
+        with self.batch():
+            self._insert(rows, buffers)
+            if self._front_cache is not None:
+                for row in rows:
+                    self._front_cache.pop(row[:2])
+            self._check_evict(len(rows))
+
+    def _remove_many(self, keys):
+        self.check_clean_up()
+        with self.batch():
+            self._delete_keys(set(keys))
+
+    def _encode(self, key, data, expires, accessed):
+        # Returns the cached row and the blobs rows of the given entry
+        buffers = None if self._buffer_threshold is None else []
+        data_format, data = self._serialize(data, buffers, self._buffer_threshold)
+        data, compression, zdict_id = self._compress(data)
+        size = len(data)
+        blobs = []
+        if self._chunk_threshold is not None and size >= self._chunk_threshold:
+            # Large data is split into blobs (without copying it), so no single row gets too large
+            view = memoryview(data)
+            blobs = [key + (idx, view[start:start + self._chunk_size])
+                     for idx, start in enumerate(range(0, size, self._chunk_size))]
+            data = b""
+        chunks = len(blobs)
+        for buffer in buffers or ():
+            size += buffer.nbytes
+            blobs.append(key + (len(blobs), buffer))
+        return key + (memoryview(data), data_format, compression, zdict_id, expires, size, accessed, len(blobs),
+                      chunks), blobs
+
+    def open_reader(self, key, hashed_key=False, identifier=_ADDON_VERSION):
+        key = self._generate_key(key, hashed_key=hashed_key, identifier=identifier, create=False)
+        conn = self._open_connection()
+        try:
+            conn.execute("BEGIN")
+            now = time.time()
+            row = conn.execute(
+                "SELECT data, format, compression, chunks FROM `cached` "
+                "WHERE identifier = ? AND key = ? AND expires > ?", key + (now,)).fetchone()
+            # Only raw bytes entries can be streamed
+            if row is None or row[1] != _BYTES_TAG or row[2]:
+                self._close_connection(conn)
+                return None
+            if not row[3]:
+                self._close_connection(conn)
+                self._track_access(key, now)
+                return io.BytesIO(row[0])
+            blobs = conn.execute(
+                "SELECT id, LENGTH(data) FROM `blobs` WHERE identifier = ? AND key = ? AND idx < ? ORDER BY idx",
+                key + (row[3],)).fetchall()
+        except BaseException:
+            self._close_connection(conn)
+            raise
+        self._track_access(key, now)
+        return io.BufferedReader(_BlobReader(conn, blobs, self), self._stream_buffer_size)
+
+    def open_writer(self, key, ttl, hashed_key=False, identifier=_ADDON_VERSION, jitter=0):
+        return _BlobWriter(self, self._generate_key(key, hashed_key=hashed_key, identifier=identifier),
+                           jitter_ttl(ttl, jitter), self._chunk_size)
+
+    def _store_stream(self, key, file, ttl):
+        self.check_clean_up()
+        size = file.seek(0, io.SEEK_END)
+        file.seek(0)
+        now = time.time()
+        lengths = [min(self._chunk_size, size - start) for start in range(0, size, self._chunk_size)]
+        with self.batch():
+            self._insert([key + (
+                b"", _BYTES_TAG, 0, 0, now + ttl.total_seconds(), size, now, len(lengths), len(lengths))], ())
+            if hasattr(self._conn, "blobopen"):
+                # Blobs are filled in place, through a single reusable buffer
+                buffer = memoryview(bytearray(min(size, self._stream_buffer_size)))
+                for idx, length in enumerate(lengths):
+                    blob_id = self._conn.execute(
+                        "INSERT INTO `blobs` (identifier, key, idx, data) VALUES(?, ?, ?, ZEROBLOB(?))",
+                        key + (idx, length)).lastrowid
+                    with self._conn.blobopen("blobs", "data", blob_id) as blob:
+                        while length > 0:
+                            n = file.readinto(buffer[:min(length, len(buffer))])
+                            blob.write(buffer[:n])
+                            length -= n
+            else:
+                for idx, length in enumerate(lengths):
+                    self._conn.execute(
+                        "INSERT INTO `blobs` (identifier, key, idx, data) VALUES(?, ?, ?, ?)",
+                        key + (idx, file.read(length)))
+            if self._front_cache is not None:
+                self._front_cache.pop(key)
+            self._check_evict(1)
+
+    def _compress(self, data):
+        if self._compression is not None and len(data) >= self._compression_threshold:
+            zdict_id = 0
+            if self._compression == "zdict":
+                zdict_id = self._get_zdict_id()
+            if zdict_id:
+                import zlib
+                compressor = zlib.compressobj(zdict=self._get_zdict(zdict_id))
+                compressed = compressor.compress(data) + compressor.flush()
+                compression = _ZDICT
+            else:
+                # Until a dictionary is trained, zdict behaves as plain zlib
+                name = "zlib" if self._compression == "zdict" else self._compression
+                from importlib import import_module
+                compressed = import_module(name).compress(data)
+                compression = _COMPRESSION_IDS[name]
+            # Data which does not compress is stored as is
+            if len(compressed) < len(data):
+                return compressed, compression, zdict_id
+        return data, 0, 0
+
+    def _decompress(self, data, compression, zdict_id):
+        if compression == _ZDICT:
+            import zlib
+            decompressor = zlib.decompressobj(zdict=self._get_zdict(zdict_id))
+            return decompressor.decompress(data) + decompressor.flush()
+        if compression:
+            from importlib import import_module
+            return import_module(_COMPRESSIONS[compression]).decompress(data)
+        return data
+
+    def _decode(self, data, data_format, compression, zdict_id, buffers=()):
+        return self._deserialize(data_format, self._decompress(data, compression, zdict_id), buffers)
+
+    def _get_zdict_id(self):
+        # Rows without data record failed trainings
+        if self._zdict_id is None:
+            row = self._conn.execute(
+                "SELECT id, data FROM `zdicts` WHERE LENGTH(data) > 0 ORDER BY id DESC LIMIT 1").fetchone()
+            if row is None:
+                self._zdict_id = 0
+            else:
+                self._zdict_id = row[0]
+                self._zdicts[row[0]] = bytes(row[1])
+        return self._zdict_id
+
+    def _get_zdict(self, zdict_id):
+        zdict = self._zdicts.get(zdict_id)
+        if zdict is None:
+            # Dictionaries are never modified, only added (possibly by other processes) and removed once unused
+            row = self._conn.execute("SELECT data FROM `zdicts` WHERE id = ?", (zdict_id,)).fetchone()
+            if row is None:
+                raise _MissingZdict(zdict_id)
+            zdict = self._zdicts[zdict_id] = bytes(row[0])
+        return zdict
+
+    def train_zdict(self):
+        # Keys are sampled first, so only the data of the sampled entries is read. Only the beginning of larger values
+        # is used, which is where they usually share the most
+        keys = self._conn.execute(
+            "SELECT identifier, key FROM `cached` ORDER BY RANDOM() LIMIT ?", (self._zdict_samples,)).fetchall()
+        samples = []
+        for key in keys:
+            row = self._conn.execute(
+                "SELECT CASE compression WHEN 0 THEN SUBSTR(data, 1, ?) ELSE data END, compression, zdict "
+                "FROM `cached` WHERE identifier = ? AND key = ? AND chunks = 0", (self._zdict_size,) + key).fetchone()
+            if row is not None:
+                try:
+                    samples.append(self._decompress(*row)[:self._zdict_size])
+                except _MissingZdict:
+                    pass
+        if len(samples) < self._zdict_min_samples:
+            return None
+        zdict = _train_zdict(samples, self._zdict_size)
+        if not zdict:
+            # The failed attempt is recorded, so it is not retried right away
+            with self.batch():
+                self._conn.execute("DELETE FROM `zdicts` WHERE LENGTH(data) = 0")
+                self._conn.execute("INSERT INTO `zdicts` (data, created) VALUES(?, ?)", (b"", time.time()))
+            return None
+        zdict_id = self._conn.execute(
+            "INSERT INTO `zdicts` (data, created) VALUES(?, ?)", (zdict, time.time())).lastrowid
+        self._zdicts[zdict_id] = zdict
+        self._zdict_id = zdict_id
+        return zdict_id
+
+    def _check_zdict(self, train=False):
+        # Other caches (possibly in other processes) switch to the newest dictionary on their next clean up, so older
+        # ones are only removed once the newest one is old enough, and for as long as there are entries compressed
+        # with them
+        self._conn.execute(
+            "DELETE FROM `zdicts` WHERE id < (SELECT MAX(id) FROM `zdicts` WHERE LENGTH(data) > 0 AND created <= ?) "
+            "AND id NOT IN (SELECT zdict FROM `cached`)", (time.time() - self._zdict_prune_delay.total_seconds(),))
+        self._zdict_id = None
+        # Training is too slow to happen inline, so it is only done by the background clean up
+        if train and self._compression == "zdict" and not self._get_zdict_id():
+            last_attempt = self._conn.execute("SELECT MAX(created) FROM `zdicts`").fetchone()[0]
+            if last_attempt is None or last_attempt + self._zdict_retry_interval.total_seconds() <= time.time():
+                self.train_zdict()
+
+    def _chunk_keys(self, keys):
+        groups = {}
+        for identifier, key in keys:
+            groups.setdefault(identifier, []).append(key)
+        for identifier, group in groups.items():
+            for i in range(0, len(group), self._max_variables):
+                yield identifier, group[i:i + self._max_variables]
+
+    def _delete_keys(self, keys):
+        keys = list(keys)
+        for identifier, chunk in self._chunk_keys(keys):
+            self._conn.execute(
+                "DELETE FROM `cached` WHERE identifier = ? AND key IN ({})".format(", ".join("?" * len(chunk))),
+                [identifier] + chunk)
+        for key in keys:
+            self._accesses.pop(key, None)
+            if self._front_cache is not None:
+                self._front_cache.pop(key)
+
+    def _generate_key(self, key, hashed_key=False, identifier="", create=True):
+        if identifier is _ADDON_VERSION:
+            identifier = get_addon_version()
+        if not hashed_key:
+            key = self._hash(key)
+        return self._get_identifier_id(identifier or "", create), _encode_key(key)
+
+    def _get_identifier_id(self, identifier, create=True):
+        # Identifiers are only added on writes. Keys read with an unknown identifier get a NULL id, which matches no row
+        identifier_id = self._identifier_ids.get(identifier)
+        if identifier_id is None:
+            row = self._conn.execute("SELECT id FROM `identifiers` WHERE name = ?", (identifier,)).fetchone()
+            if row is None:
+                if not create:
+                    return None
+                self._conn.execute("INSERT OR IGNORE INTO `identifiers` (name) VALUES(?)", (identifier,))
+                row = self._conn.execute("SELECT id FROM `identifiers` WHERE name = ?", (identifier,)).fetchone()
+            identifier_id = row[0]
+            # Identifiers which may not be committed yet (and thus may be rolled back) are not kept
+            if not self._conn.in_transaction:
+                self._identifier_ids[identifier] = identifier_id
+        return identifier_id
+
+    def enable_front_cache(self, max_size):
+        if max_size <= 0:
+            self._front_cache = None
+        elif self._front_cache is None:
+            self._front_cache = _LRUCache(max_size)
+        elif max_size > self._front_cache.max_size:
+            self._front_cache.resize(max_size)
+
+    def _acquire_lease(self, key, owner, ttl):
+        now = time.time()
+        with self.batch():
+            # Expired leases (for instance, from crashed processes) can be taken over
+            self._conn.execute("DELETE FROM `leases` WHERE identifier = ? AND key = ? AND expires <= ?", key + (now,))
+            return self._conn.execute(
+                "INSERT OR IGNORE INTO `leases` (identifier, key, owner, expires) VALUES(?, ?, ?, ?)",
+                key + (owner, now + ttl.total_seconds())).rowcount == 1
+
+    def _release_lease(self, key, owner):
+        self._conn.execute("DELETE FROM `leases` WHERE identifier = ? AND key = ? AND owner = ?", key + (owner,))
+
+    @property
+    def bounded(self):
+        return self._max_entries is not None or self._max_size_bytes is not None
+
+    def _track_access(self, key, accessed=None):
+        if self.bounded:
+            hits = self._accesses.get(key, (0, 0))[1]
+            self._accesses[key] = (time.time() if accessed is None else accessed, hits + 1)
+            if len(self._accesses) >= self._max_pending_accesses:
+                import sqlite3
+                try:
+                    self._flush_accesses()
+                except sqlite3.OperationalError:
+                    # Accesses only drive evictions, so they are dropped rather than failing the read (for instance,
+                    # if another connection holds the write lock)
+                    pass
+
+    def _flush_accesses(self):
+        if self._accesses:
+            accesses, self._accesses = self._accesses, {}
+            with self.batch():
+                self._conn.executemany(
+                    "UPDATE `cached` SET accessed = MAX(accessed, ?), hits = hits + ? WHERE identifier = ? AND key = ?",
+                    [(accessed, hits) + key for key, (accessed, hits) in accesses.items()])
+
+    def _check_evict(self, writes):
+        if self.bounded:
+            self._writes += writes
+            if self._writes >= self._eviction_check_writes:
+                self.evict()
+
+    def evict(self):
+        self._writes = 0
+        if not self.bounded:
+            return 0
+        evicted = 0
+        with self.batch():
+            self._flush_accesses()
+            if self._max_entries is not None:
+                count = self._conn.execute("SELECT COUNT(*) FROM `cached`").fetchone()[0]
+                if count > self._max_entries:
+                    keys = self._conn.execute(
+                        "SELECT identifier, key FROM `cached` ORDER BY {} LIMIT ?".format(self._eviction_order),
+                        (count - int(self._max_entries * self._eviction_target),)).fetchall()
+                    self._delete_keys(keys)
+                    evicted += len(keys)
+            if self._max_size_bytes is not None:
+                total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM `cached`").fetchone()[0]
+                if total > self._max_size_bytes:
+                    to_free = total - int(self._max_size_bytes * self._eviction_target)
+                    keys = []
+                    for identifier, key, size in self._conn.execute(
+                            "SELECT identifier, key, size FROM `cached` ORDER BY {}".format(self._eviction_order)):
+                        keys.append((identifier, key))
+                        to_free -= size
+                        if to_free <= 0:
+                            break
+                    self._delete_keys(keys)
+                    evicted += len(keys)
+        return evicted
+
+    @_contextmanager
+    def batch(self):
+        # Nested batches are part of the outermost transaction
+        if self._conn.in_transaction:
+            yield self
+            return
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield self
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._conn.execute("COMMIT")
+
+    def _migrate(self):
+        with self.batch():
+            version = self.version
+            if version == 0:
+                # Initial schema, also used by databases created before versioning was introduced
+                self._conn.execute(
+                    "CREATE TABLE IF NOT EXISTS `cached` ("
+                    "key TEXT PRIMARY KEY NOT NULL, "
+                    "data BLOB NOT NULL, "
+                    "expires TEXT NOT NULL"
+                    ")")
+            for statements in self._migrations[version:]:
+                for statement in statements:
+                    if callable(statement):
+                        statement(self._conn)
+                    else:
+                        self._conn.execute(statement)
+            if version < len(self._migrations):
+                self._set_version(len(self._migrations))
 
     def _set_version(self, version):
         self._conn.execute("PRAGMA user_version={}".format(version))
@@ -204,52 +1691,473 @@ class Cache(_BaseCache):
     def needs_cleanup(self):
         return self._last_cleanup + self._cleanup_interval < self._now()
 
-    def clean_up(self):
-        self._conn.execute(
-            "DELETE FROM `cached` WHERE expires <= STRFTIME('%Y-%m-%d %H:%M:%f', 'NOW')")
+    def clean_up(self, chunk_size=None):
+        self._delete_expired(self._conn, chunk_size)
         self._last_cleanup = self._now()
+        self.evict()
+        self._check_zdict()
 
     def check_clean_up(self):
-        clean_up = self.needs_cleanup
+        clean_up = not self._background_cleanup and self.needs_cleanup
         if clean_up:
             self.clean_up()
         return clean_up
 
     def clear(self):
         self._conn.execute("DELETE FROM `cached`")
+        self._accesses.clear()
+        if self._front_cache is not None:
+            self._front_cache.clear()
         self._last_cleanup = self._now()
 
     def close(self):
-        self._conn.close()
+        if self._cleanup_thread is not None:
+            self._stop_cleanup.set()
+            self._cleanup_thread.join()
+            self._cleanup_thread = None
+        with self._connections_lock:
+            if self._connections:
+                self._flush_accesses()
+            for conn in self._connections:
+                conn.close()
+            del self._connections[:]
+            self._local = threading.local()
+            self._initialized = False
+
+
+class _Call(object):
+    def __init__(self):
+        self.owner = threading.current_thread()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class _SingleFlight(object):
+    def __init__(self, timeout=None):
+        self._timeout = timeout
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func):
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = _Call()
+                leader = True
+            else:
+                leader = False
+
+        if not leader:
+            # Reentrant calls and waiters which time out compute the result on their own
+            if call.owner is not threading.current_thread() and call.done.wait(self._timeout):
+                if call.error is not None:
+                    raise call.error
+                return call.result
+            return func()
+
+        try:
+            call.result = func()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+
+class _RefreshExecutor(object):
+    def __init__(self, max_workers=2, max_pending=None):
+        self._max_workers = max_workers
+        self._max_pending = max_pending
+        self._executor = None
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def submit(self, key, func, *args, **kwargs):
+        with self._lock:
+            # Refreshes already queued or running for the same key are not submitted again, and neither are refreshes
+            # exceeding the queue size
+            if key in self._pending or (self._max_pending is not None and len(self._pending) >= self._max_pending):
+                return False
+            self._pending.add(key)
+            if self._executor is None:
+                from concurrent.futures import ThreadPoolExecutor
+                self._executor = ThreadPoolExecutor(max_workers=self._max_workers)
+        self._executor.submit(self._run, key, func, args, kwargs)
+        return True
+
+    def _run(self, key, func, args, kwargs):
+        try:
+            func(*args, **kwargs)
+        except Exception:
+            # A failed refresh leaves the current entry in place
+            pass
+        finally:
+            with self._lock:
+                self._pending.discard(key)
+
+
+@_lazy
+def _get_refresh_executor():
+    return _RefreshExecutor()
+
+
+class _Entry(object):
+    # Time before which a failed load is not retried
+    retry_after = 0
+    # Time the entry took to load
+    delta = 0
+
+    def __init__(self, data, fresh_until, delta=0):
+        self.data = data
+        self.fresh_until = fresh_until
+        self.delta = delta
+
+
+class _CacheLoader(object):
+    _lease_poll_interval = 0.1
+
+    def __init__(self, ttl, identifier=_ADDON_VERSION, single_flight=False, wait_timeout=None, lease_ttl=None,
+                 stale_ttl=None, error_ttl=None, retry_interval=None, early_refresh_beta=None, ttl_jitter=0,
+                 refresh_ahead=None, executor=None):
+        self._ttl = ttl
+        self._identifier = identifier
+        self._single_flight = _SingleFlight(wait_timeout) if single_flight else None
+        self._lease_ttl = lease_ttl
+        self._stale_ttl = stale_ttl
+        self._error_ttl = error_ttl
+        self._retry_interval = retry_interval
+        self._early_refresh_beta = early_refresh_beta
+        self._ttl_jitter = ttl_jitter
+        self._refresh_ahead = refresh_ahead
+        self._executor = executor
+        # Period for which entries are kept after they are no longer fresh
+        self._grace_ttl = max((t for t in (stale_ttl, error_ttl) if t is not None), default=None)
+        self._use_entries = self._grace_ttl is not None or early_refresh_beta is not None or refresh_ahead is not None
+        self._sentinel = object()
+
+    @property
+    def executor(self):
+        return _get_refresh_executor() if self._executor is None else self._executor
+
+    def get(self, cache, key, loader, *args, **kwargs):
+        # noinspection PyProtectedMember
+        return self.get_hashed(cache, cache._hash(key), loader, args, kwargs)
+
+    def get_hashed(self, cache, key, loader, args, kwargs):
+        entry = self._get_cached(cache, key)
+        if entry is self._sentinel:
+            return self._load_missing(cache, key, loader, args, kwargs)
+
+        data = self._serve(cache, key, loader, args, kwargs, entry)
+        if data is not self._sentinel:
+            return data
+        if self._error_ttl is None:
+            return self._load_missing(cache, key, loader, args, kwargs)
+        try:
+            return self._load_missing(cache, key, loader, args, kwargs)
+        except Exception:
+            # Serve the stale entry if loading fails
+            self._set_failed(cache, key, entry)
+            return entry.data
+
+    def get_many_hashed(self, cache, keys, loader, load_many):
+        # Same as get_hashed, for a {key: (args, kwargs)} dict, where all the entries to load are loaded at once by
+        # load_many, which returns them as a {key: data} dict
+        result = {}
+        stale = {}
+        missing = []
+        for key, entry in self.get_cached_many(cache, list(keys)).items():
+            if entry is not self._sentinel:
+                args, kwargs = keys[key]
+                data = self._serve(cache, key, loader, args, kwargs, entry)
+                if data is not self._sentinel:
+                    result[key] = data
+                    continue
+                stale[key] = entry
+            missing.append(key)
+
+        if missing:
+            start = time.time()
+            try:
+                loaded = load_many(missing)
+            except Exception:
+                if self._error_ttl is None:
+                    raise
+                # Serve the stale entries if loading fails, unless some of the entries to load have none
+                for key, entry in stale.items():
+                    self._set_failed(cache, key, entry)
+                    result[key] = entry.data
+                if len(stale) < len(missing):
+                    raise
+            else:
+                self.store_many(cache, loaded, time.time() - start)
+                result.update(loaded)
+        return result
+
+    def _serve(self, cache, key, loader, args, kwargs, entry):
+        # Returns the data of the cached entry if it can be served (refreshing it in background if needed), or the
+        # sentinel if it has to be loaded
+        data, fresh = self._unwrap(entry)
+        if fresh:
+            if self.should_refresh(entry):
+                self.refresh_in_background(cache, key, loader, args, kwargs, entry)
+            return data
+        now = time.time()
+        if entry.retry_after > now:
+            # Loading has failed recently, so keep serving the stale entry
+            return data
+        if self._stale_ttl is not None and now < entry.fresh_until + self._stale_ttl.total_seconds():
+            # Serve the stale entry while it is refreshed in background
+            self.refresh_in_background(cache, key, loader, args, kwargs, entry)
+            return data
+        return self._sentinel
+
+    def _load_missing(self, cache, key, loader, args, kwargs):
+        if self._single_flight is None:
+            return self._load(cache, key, loader, args, kwargs)
+        return self._single_flight.do(key, lambda: self._load(cache, key, loader, args, kwargs, True))
+
+    def _get_cached(self, cache, key):
+        return cache.get(key, default=self._sentinel, hashed_key=True, identifier=self._identifier)
+
+    def _unwrap(self, entry):
+        if isinstance(entry, _Entry):
+            return entry.data, entry.fresh_until > time.time()
+        return entry, True
+
+    def get_cached_many(self, cache, keys):
+        return cache.get_many(keys, default=self._sentinel, hashed_key=True, identifier=self._identifier)
+
+    def get_fresh_many(self, cache, keys):
+        fresh = {}
+        for key, entry in self.get_cached_many(cache, keys).items():
+            if entry is not self._sentinel:
+                data, is_fresh = self._unwrap(entry)
+                if is_fresh:
+                    fresh[key] = data
+        return fresh
+
+    def should_refresh(self, entry):
+        if entry is self._sentinel:
+            return True
+        if not isinstance(entry, _Entry) or entry.retry_after > time.time():
+            return False
+        # Refresh ahead entries which are within the last fraction of their ttl
+        if self._refresh_ahead is not None and \
+                entry.fresh_until - time.time() <= self._ttl.total_seconds() * self._refresh_ahead:
+            return True
+        # Probabilistic early expiration (XFetch), where entries which take longer to load are refreshed earlier
+        from math import log
+        from random import random
+        return self._early_refresh_beta is not None and \
+            time.time() - entry.delta * self._early_refresh_beta * log(1 - random()) >= entry.fresh_until
+
+    def refresh_in_background(self, cache, key, loader, args, kwargs, entry):
+        return self.executor.submit((id(self), key), self._refresh, cache, key, loader, args, kwargs, entry)
+
+    def _store(self, cache, key, data, delta=0):
+        self.store_many(cache, {key: data}, delta)
+
+    def store_many(self, cache, mapping, delta=0):
+        now = time.time()
+        items = []
+        for key, data in mapping.items():
+            # Each entry gets its own jitter, so entries loaded together do not expire together
+            ttl = jitter_ttl(self._ttl, self._ttl_jitter)
+            if self._use_entries:
+                data = _Entry(data, now + ttl.total_seconds(), delta)
+                if self._grace_ttl is not None:
+                    ttl += self._grace_ttl
+            items.append((key, data, ttl))
+        if len(items) == 1:
+            key, data, ttl = items[0]
+            cache.set(key, data, ttl, hashed_key=True, identifier=self._identifier)
+        else:
+            # noinspection PyProtectedMember
+            cache._set_many([(cache._generate_key(key, hashed_key=True, identifier=self._identifier), data, ttl)
+                             for key, data, ttl in items])
+
+    def _set_failed(self, cache, key, entry):
+        # Without stale_ttl or error_ttl, expired entries are never kept, so there is nothing to retry later
+        if self._retry_interval is None or self._grace_ttl is None or not isinstance(entry, _Entry):
+            return
+        now = time.time()
+        remaining = entry.fresh_until + self._grace_ttl.total_seconds() - now
+        if remaining > 0:
+            entry.retry_after = now + self._retry_interval.total_seconds()
+            cache.set(key, entry, timedelta(seconds=remaining), hashed_key=True, identifier=self._identifier)
+
+    def _load(self, cache, key, loader, args, kwargs, check_cache=False):
+        if self._lease_ttl is None:
+            return self._load_value(cache, key, loader, args, kwargs, check_cache)
+        # Only the lease owner loads the entry, while other processes wait for it to be stored
+        while True:
+            owner = cache.acquire_lease(key, self._lease_ttl, hashed_key=True, identifier=self._identifier)
+            if owner is not None:
+                try:
+                    # The previous owner may have stored the entry right before releasing the lease
+                    return self._load_value(cache, key, loader, args, kwargs, True)
+                finally:
+                    cache.release_lease(key, owner, hashed_key=True, identifier=self._identifier)
+            time.sleep(self._lease_poll_interval)
+            data = self._get_fresh(cache, key)
+            if data is not self._sentinel:
+                return data
+
+    def _get_fresh(self, cache, key):
+        entry = self._get_cached(cache, key)
+        if entry is not self._sentinel:
+            data, fresh = self._unwrap(entry)
+            if fresh:
+                return data
+        return self._sentinel
+
+    def _load_value(self, cache, key, loader, args, kwargs, check_cache=False):
+        if check_cache:
+            # Another caller may have loaded the entry in the meantime
+            data = self._get_fresh(cache, key)
+            if data is not self._sentinel:
+                return data
+        start = time.time()
+        data = loader(*args, **kwargs)
+        self._store(cache, key, data, time.time() - start)
+        return data
+
+    def _refresh(self, cache, key, loader, args, kwargs, entry):
+        owner = None
+        if self._lease_ttl is not None:
+            # Some other process is already refreshing the entry
+            owner = cache.acquire_lease(key, self._lease_ttl, hashed_key=True, identifier=self._identifier)
+            if owner is None:
+                return
+        try:
+            start = time.time()
+            data = loader(*args, **kwargs)
+            self._store(cache, key, data, time.time() - start)
+        except Exception:
+            self._set_failed(cache, key, entry)
+            raise
+        finally:
+            if owner is not None:
+                cache.release_lease(key, owner, hashed_key=True, identifier=self._identifier)
 
 
 class LoadingCache(object):
     def __init__(self, ttl, loader, cache_type, *args, **kwargs):
         self._ttl = ttl
         self._loader = loader
-        self._identifier = kwargs.pop("identifier", ADDON_VERSION)
+        self._bulk_loader = kwargs.pop("bulk_loader", None)
+        self._load_workers = kwargs.pop("load_workers", 1)
+        self._refresh_ahead = kwargs.pop("refresh_ahead", None)
+        self._refresh_window = kwargs.pop("refresh_window", timedelta(minutes=10))
+        refresh_workers = kwargs.pop("refresh_workers", 2)
+        refresh_queue_size = kwargs.pop("refresh_queue_size", 100)
+        executor = None
+        if self._refresh_ahead is not None:
+            executor = _RefreshExecutor(max_workers=refresh_workers, max_pending=refresh_queue_size)
+        self._cache_loader = _CacheLoader(
+            ttl, identifier=kwargs.pop("identifier", _ADDON_VERSION),
+            single_flight=kwargs.pop("single_flight", False), wait_timeout=kwargs.pop("wait_timeout", None),
+            lease_ttl=kwargs.pop("lease_ttl", None), stale_ttl=kwargs.pop("stale_ttl", None),
+            error_ttl=kwargs.pop("error_ttl", None), retry_interval=kwargs.pop("retry_interval", None),
+            early_refresh_beta=kwargs.pop("early_refresh_beta", None), ttl_jitter=kwargs.pop("ttl_jitter", 0),
+            refresh_ahead=self._refresh_ahead, executor=executor)
         self._cache = cache_type(*args, **kwargs)
-        self._sentinel = object()
+        # Keys read within the refresh window, which are kept fresh by the refresh ahead scheduler
+        self._recent_keys = {}
+        self._recent_keys_lock = threading.Lock()
+        self._scheduler = None
+        self._stop_scheduler = threading.Event()
 
     def get(self, *args, **kwargs):
-        key = make_key(args, kwargs)
-        data = self._cache.get(key, default=self._sentinel, identifier=self._identifier)
-        if data is self._sentinel:
-            data = self._loader(*args, **kwargs)
-            self._cache.set(key, data, self._ttl, identifier=self._identifier)
-        return data
+        # noinspection PyProtectedMember
+        key = self._cache._hash(make_key(args, kwargs))
+        if self._refresh_ahead is not None:
+            self._track(key, args, kwargs)
+        return self._cache_loader.get_hashed(self._cache, key, self._loader, args, kwargs)
+
+    def get_all(self, keys):
+        # noinspection PyProtectedMember
+        hashed_keys = {key: self._cache._hash(make_key((key,), {})) for key in keys}
+        if self._refresh_ahead is not None:
+            for key, hashed_key in hashed_keys.items():
+                self._track(hashed_key, (key,), {})
+        keys_by_hash = {hashed_key: key for key, hashed_key in hashed_keys.items()}
+
+        def load_many(missing):
+            loaded = self._load_all([keys_by_hash[hashed_key] for hashed_key in missing])
+            return {hashed_keys[key]: data for key, data in loaded.items() if key in hashed_keys}
+
+        result = self._cache_loader.get_many_hashed(
+            self._cache, {hashed_key: ((key,), {}) for key, hashed_key in hashed_keys.items()}, self._loader,
+            load_many)
+        return {key: result[hashed_key] for key, hashed_key in hashed_keys.items() if hashed_key in result}
+
+    def _load_all(self, keys):
+        if self._bulk_loader is not None:
+            loaded = self._bulk_loader(keys)
+            return loaded if isinstance(loaded, dict) else dict(zip(keys, loaded))
+        if self._load_workers > 1 and len(keys) > 1:
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(max_workers=min(self._load_workers, len(keys))) as executor:
+                return dict(zip(keys, executor.map(self._loader, keys)))
+        return {key: self._loader(key) for key in keys}
+
+    def _track(self, key, args, kwargs):
+        with self._recent_keys_lock:
+            self._recent_keys[key] = (args, kwargs, time.time())
+            if self._scheduler is None:
+                self._stop_scheduler.clear()
+                self._scheduler = threading.Thread(target=self._schedule_refreshes, name="cached-refresh-ahead")
+                self._scheduler.daemon = True
+                self._scheduler.start()
+
+    def _schedule_refreshes(self):
+        interval = max(self._ttl.total_seconds() * self._refresh_ahead / 2, 1)
+        while not self._stop_scheduler.wait(interval):
+            min_read = time.time() - self._refresh_window.total_seconds()
+            with self._recent_keys_lock:
+                for key in [k for k, (_, _, read) in self._recent_keys.items() if read < min_read]:
+                    del self._recent_keys[key]
+                recent_keys = dict(self._recent_keys)
+            if not recent_keys:
+                continue
+            entries = self._cache_loader.get_cached_many(self._cache, list(recent_keys))
+            for key, (args, kwargs, _) in recent_keys.items():
+                entry = entries[key]
+                if self._cache_loader.should_refresh(entry):
+                    self._cache_loader.refresh_in_background(self._cache, key, self._loader, args, kwargs, entry)
 
     def close(self):
+        if self._scheduler is not None:
+            self._stop_scheduler.set()
+            self._scheduler.join()
+            self._scheduler = None
         self._cache.close()
 
 
-def cached(ttl, instance_method=False, identifier=ADDON_VERSION, cache_type=Cache):
+def cached(ttl, instance_method=False, identifier=_ADDON_VERSION, cache_type=Cache, front_cache_size=0,
+           single_flight=False, wait_timeout=None, lease_ttl=None, stale_ttl=None, error_ttl=None, retry_interval=None,
+           early_refresh_beta=None, ttl_jitter=0):
     def decorator(func):
-        sentinel = object()
-        cache = cache_type.get_instance()
+        cache_loader = _CacheLoader(
+            ttl, identifier=identifier, single_flight=single_flight, wait_timeout=wait_timeout, lease_ttl=lease_ttl,
+            stale_ttl=stale_ttl, error_ttl=error_ttl, retry_interval=retry_interval,
+            early_refresh_beta=early_refresh_beta, ttl_jitter=ttl_jitter)
+        cache = None
 
         @wraps(func)
         def wrapper(*args, **kwargs):
+            nonlocal cache
+            if cache is None:
+                cache = cache_type.get_instance()
+                if front_cache_size:
+                    cache.enable_front_cache(front_cache_size)
+
             if instance_method:
                 key_args = args[1:]
                 func_name = args[0].__class__.__name__ + "." + func.__name__
@@ -257,13 +2165,48 @@ def cached(ttl, instance_method=False, identifier=ADDON_VERSION, cache_type=Cach
                 key_args = args
                 func_name = func.__name__
 
-            key = make_key((func_name, *key_args), kwargs)
-            result = cache.get(key, default=sentinel, identifier=identifier)
-            if result is sentinel:
-                result = func(*args, **kwargs)
-                cache.set(key, result, ttl, identifier=identifier)
+            return cache_loader.get(cache, make_key((func_name, *key_args), kwargs), func, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def cached_batch(ttl, instance_method=False, identifier=_ADDON_VERSION, cache_type=Cache):
+    def decorator(func):
+        cache_loader = _CacheLoader(ttl, identifier=identifier)
+        cache = None
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            nonlocal cache
+            if cache is None:
+                cache = cache_type.get_instance()
+
+            if instance_method:
+                items, key_args = args[1], args[2:]
+                func_name = args[0].__class__.__name__ + "." + func.__name__
+            else:
+                items, key_args = args[0], args[1:]
+                func_name = func.__name__
+
+            items = list(items)
+            # noinspection PyProtectedMember
+            hashed_keys = {item: cache._hash(make_key((func_name, item, *key_args), kwargs)) for item in items}
+            results = cache_loader.get_fresh_many(cache, list(hashed_keys.values()))
+            missing = [item for item, key in hashed_keys.items() if key not in results]
+
+            if missing:
+                loaded = func(*args[:1], missing, *key_args, **kwargs) if instance_method else \
+                    func(missing, *key_args, **kwargs)
+                if not isinstance(loaded, dict):
+                    loaded = dict(zip(missing, loaded))
+                loaded = {hashed_keys[item]: data for item, data in loaded.items() if item in hashed_keys}
+                if loaded:
+                    cache_loader.store_many(cache, loaded)
+                    results.update(loaded)
 
-            return result
+            return [results.get(hashed_keys[item]) for item in items]
 
         return wrapper
 
@@ -271,5 +2214,5 @@ def cached(ttl, instance_method=False, identifier=ADDON_VERSION, cache_type=Cach
 
 
 # noinspection PyTypeChecker
-def memory_cached(ttl, instance_method=False, identifier=ADDON_VERSION):
+def memory_cached(ttl, instance_method=False, identifier=_ADDON_VERSION):
     return cached(ttl, instance_method=instance_method, identifier=identifier, cache_type=MemoryCache)